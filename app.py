@@ -1,5 +1,6 @@
 import os
 import html
+import hashlib
 import streamlit as st
 import google.generativeai as genai
 from neo4j import GraphDatabase
@@ -53,115 +54,193 @@ LLM_MODEL = 'gemini-2.0-flash'
 def get_driver():
     return GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
 
-def get_embedding(text):
+def get_session():
+    # Una sessione Neo4j per sessione Streamlit: i rerun dello stesso utente sono sequenziali,
+    # mentre utenti diversi (thread diversi) non condividono mai la stessa sessione
+    if st.session_state.get("neo4j_session") is None:
+        driver = get_driver()
+        if not driver: return None
+        st.session_state.neo4j_session = driver.session()
+    return st.session_state.neo4j_session
+
+def reset_session():
+    session = st.session_state.pop("neo4j_session", None)
+    if session is not None:
+        try: session.close()
+        except Exception: pass
+
+@st.cache_data(show_spinner=False, max_entries=1024)
+def _embed_query(text: str, model: str = EMBEDDING_MODEL):
+    # Le eccezioni non vengono messe in cache: un errore API viene ritentato al prossimo click
+    result = genai.embed_content(model=model, content=text, task_type="RETRIEVAL_QUERY")
+    return result['embedding']
+
+def get_embedding(text: str, model: str = EMBEDDING_MODEL):
     try:
-        result = genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type="RETRIEVAL_QUERY")
-        return result['embedding']
+        return _embed_query(text[:9000], model)
     except Exception as e:
         return None
 
-# --- BRONZE STANDARD (VECTOR ONLY) ---
-def vector_only_search(embedding, top_k=5):
-    driver = get_driver()
-    if not driver: return []
-    
-    query = """
+def get_session_embedding(text):
+    # Riusa lo stesso oggetto lista per input identici nella sessione utente:
+    # evita anche la copia (unpickle) che st.cache_data fa a ogni hit
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    last = st.session_state.get("last_emb")
+    if last and last[0] == key: return last[1]
+    emb = get_embedding(text)
+    if emb: st.session_state.last_emb = (key, emb)
+    return emb
+
+# --- RICERCA A CASCATA: GOLD -> SILVER -> BRONZE ---
+# Gold:   traversata del grafo dagli anchor, filtrata per esito favorevole alla strategia
+# Silver: traversata del grafo senza filtro
+# Bronze: solo similarita' vettoriale sugli anchor
+# Un'unica query: il vector index viene interrogato una volta e i tre livelli sono
+# calcolati come subquery in UNION ALL; in Python si tiene il primo livello con risultati.
+# Il testo e' statico (la strategia e' un parametro) cosi' Neo4j riusa il piano in cache.
+SEARCH_TIERS = ("Gold", "Silver", "Bronze")
+
+CASCADING_SEARCH_QUERY = """
     CALL db.index.vector.queryNodes($index_name, $top_k, $embedding)
-    YIELD node AS case, score
+    YIELD node AS anchorCase, score
+    WITH collect({anchor: anchorCase, score: score}) AS anchors
     
-    OPTIONAL MATCH (case)-[:HAS_TEXT]->(t:TEXT)
+    CALL {
+        WITH anchors
+        UNWIND anchors AS a
+        WITH a.anchor AS anchorCase, a.score AS score
+        MATCH (anchorCase)-[link:CITES_TRANSITIVE]->(precedent:CASE)
+        WHERE ($strategy = 'defense' AND precedent.outcome IN ['reversed', 'acquitted'])
+           OR ($strategy = 'prosecution' AND precedent.outcome = 'affirmed')
+        OPTIONAL MATCH (precedent)-[:HAS_TEXT]->(precedentText:TEXT)
+        WITH precedent, precedentText,
+            sum(link.paths) as citation_count,
+            collect(DISTINCT anchorCase.name)[..3] as found_via,
+            max(score) as relevance_score
+        ORDER BY citation_count DESC, relevance_score DESC
+        LIMIT 5
+        RETURN 0 as tier, precedent as hit, precedentText as text_node, citation_count, found_via, relevance_score
+      UNION ALL
+        WITH anchors
+        UNWIND anchors AS a
+        WITH a.anchor AS anchorCase, a.score AS score
+        MATCH (anchorCase)-[link:CITES_TRANSITIVE]->(precedent:CASE)
+        OPTIONAL MATCH (precedent)-[:HAS_TEXT]->(precedentText:TEXT)
+        WITH precedent, precedentText,
+            sum(link.paths) as citation_count,
+            collect(DISTINCT anchorCase.name)[..3] as found_via,
+            max(score) as relevance_score
+        ORDER BY citation_count DESC, relevance_score DESC
+        LIMIT 5
+        RETURN 1 as tier, precedent as hit, precedentText as text_node, citation_count, found_via, relevance_score
+      UNION ALL
+        WITH anchors
+        UNWIND anchors AS a
+        WITH a.anchor AS hit, a.score AS relevance_score
+        OPTIONAL MATCH (hit)-[:HAS_TEXT]->(t:TEXT)
+        RETURN 2 as tier, hit, t as text_node, 0 as citation_count, [] as found_via, relevance_score
+    }
     
     RETURN 
-        elementId(case) as id,
-        case.name as title,
-        case.offense as offense,
-        case.decisionSummary as decision,
-        t.text as full_text,
-        0 as citation_count,
-        [] as found_via,
-        score as relevance_score
-    ORDER BY score DESC
-    """
-    try:
-        with driver.session() as session:
-            result = session.run(query, index_name=NEO4J_VECTOR_INDEX, top_k=top_k, embedding=embedding)
-            return [record.data() for record in result]
-    except Exception as e:
-        return []
+        tier,
+        elementId(hit) as id,
+        hit.name as title,
+        hit.offense as offense,
+        hit.decisionSummary as decision,
+        coalesce(hit.is_defense_favorable, false) as is_fav,
+        substring(text_node.text, 0, 500) as full_text_preview,
+        elementId(text_node) as text_id,
+        citation_count,
+        found_via,
+        relevance_score
+    ORDER BY tier, citation_count DESC, relevance_score DESC
+"""
 
-# --- GOLD & SILVER STANDARD (GRAPH) ---
-def graph_rag_search(embedding, strategy="defense", top_k_anchors=5, apply_filter=True):
-    driver = get_driver()
-    if not driver: return []
+def cascading_search(embedding, strategy="defense", top_k_anchors=5):
+    # Un solo nuovo tentativo con una sessione nuova (es. connessione caduta)
+    for attempt in range(2):
+        session = get_session()
+        if not session: return [], SEARCH_TIERS[-1]
+        try:
+            result = session.run(CASCADING_SEARCH_QUERY, index_name=NEO4J_VECTOR_INDEX, top_k=top_k_anchors, embedding=embedding, strategy=strategy)
+            records = [record.data() for record in result]
+            break
+        except Exception as e:
+            reset_session()
+    else:
+        return [], SEARCH_TIERS[-1]
 
-    filter_clause = ""
-    if apply_filter:
-        if strategy == "defense":
-            filter_clause = "WHERE (toLower(precedent.decisionSummary) CONTAINS 'reverse' OR toLower(precedent.decisionSummary) CONTAINS 'acquit')"
-        else:
-            filter_clause = "WHERE (toLower(precedent.decisionSummary) CONTAINS 'affirm')"
+    if not records: return [], SEARCH_TIERS[-1]
+    best_tier = records[0]['tier']
+    results = [{k: v for k, v in r.items() if k != 'tier'} for r in records if r['tier'] == best_tier]
+    return results, SEARCH_TIERS[best_tier]
 
-    cypher_query = f"""
-    CALL db.index.vector.queryNodes($index_name, $top_k, $embedding)
-    YIELD node AS anchorCase, score
-    MATCH (anchorCase)-[:CITES*1..2]->(precedent:CASE)
-    {filter_clause}
-    OPTIONAL MATCH (precedent)-[:HAS_TEXT]->(precedentText:TEXT)
-    RETURN 
-        elementId(precedent) as id,
-        precedent.name as title,
-        precedent.offense as offense,
-        precedent.decisionSummary as decision,
-        precedentText.text as full_text,
-        count(anchorCase) as citation_count, 
-        collect(DISTINCT anchorCase.name)[..3] as found_via,
-        max(score) as relevance_score
-    ORDER BY citation_count DESC, relevance_score DESC
-    LIMIT 5
-    """
+# Il testo completo (decine di KB) viene caricato solo quando l'utente apre l'opinione
+@st.cache_data(ttl=600, show_spinner=False)
+def _fetch_full_text(text_id):
+    session = get_session()
+    record = session.run("MATCH (t:TEXT) WHERE elementId(t) = $id RETURN t.text as text", id=text_id).single()
+    return record["text"] if record else None
+
+def get_full_text(text_id):
+    if not text_id: return None
     try:
-        with driver.session() as session:
-            result = session.run(cypher_query, index_name=NEO4J_VECTOR_INDEX, top_k=top_k_anchors, embedding=embedding)
-            return [record.data() for record in result]
+        return _fetch_full_text(text_id)
     except Exception as e:
-        return []
+        reset_session()
+        return None
+
+STRATEGY_PROFILES = {
+    "defense": ("DEFENSE ATTORNEY", "securing an acquittal"),
+    "prosecution": ("PROSECUTOR", "securing a conviction"),
+}
+
+def build_system_instruction(strategy):
+    perspective, goal = STRATEGY_PROFILES.get(strategy, STRATEGY_PROFILES["prosecution"])
+    return f"""You are a senior Texas {perspective}. Goal: {goal}.
+    CRITICAL: NEVER use placeholders like [Name]. Use generic terms like "The Defendant".
+    Write a concise strategic memo based on the precedents provided.
+    Format neatly with Markdown. Start directly with the text.
+    """
+
+# Un modello per strategia (defense/prosecution) con il preambolo invariato come
+# system instruction: costruito una volta e riusato per tutte le richieste.
+# Niente CachedContent di Gemini: il preambolo e' molto sotto la soglia minima di token.
+@st.cache_resource(show_spinner=False)
+def get_strategy_model(strategy):
+    return genai.GenerativeModel(LLM_MODEL, system_instruction=build_system_instruction(strategy))
 
 def generate_strategic_analysis(new_case_text, retrieved_cases, strategy, method_used):
-    if not retrieved_cases: return "No relevant precedents found."
+    # Generatore: restituisce il memo a pezzi man mano che Gemini lo produce
+    if not retrieved_cases:
+        yield "No relevant precedents found."
+        return
     
-    context_str = ""
-    for i, case in enumerate(retrieved_cases):
-        context_str += f"[PRECEDENT #{i+1}] {case['title']} ({case['decision']})\nExcerpt: {str(case.get('full_text', ''))[:400]}...\n\n"
+    context_str = "\n".join(
+        f"[PRECEDENT #{i+1}] {case['title']} ({case['decision']})\nExcerpt: {str(case.get('full_text_preview') or '')[:400]}...\n"
+        for i, case in enumerate(retrieved_cases)
+    )
 
-    perspective = "DEFENSE ATTORNEY" if strategy == "defense" else "PROSECUTOR"
-    goal = "securing an acquittal" if strategy == "defense" else "securing a conviction"
-    
     caveat = ""
     if "Vector" in method_used:
-        caveat = "Note: Direct precedents matching the strategy were scarce. These cases were selected based on factual similarity."
+        caveat = "Note: Direct precedents matching the strategy were scarce. These cases were selected based on factual similarity.\n"
 
-    prompt = f"""You are a senior Texas {perspective}. Goal: {goal}.
-    CRITICAL: NEVER use placeholders like [Name]. Use generic terms like "The Defendant".
-    Write a concise strategic memo based on these precedents. {caveat}
-    
-    PRECEDENTS:
+    prompt = f"""{caveat}PRECEDENTS:
     {context_str}
     CASE FACTS: {new_case_text}
-    
-    Format neatly with Markdown. Start directly with the text.
     """
     try:
-        model = genai.GenerativeModel(LLM_MODEL)
-        return model.generate_content(prompt).text
+        model = get_strategy_model(strategy)
+        for chunk in model.generate_content(prompt, stream=True):
+            yield chunk.text
     except Exception as e:
-        return f"Error: {e}"
+        yield f"Error: {e}"
 
 # ------------------------------------------------------
 # 4. UI STYLING & COMPONENTS
 # ------------------------------------------------------
 
-def load_luxury_css():
-    st.markdown("""
+LUXURY_CSS = """
     <style>
         @import url('https://fonts.googleapis.com/css2?family=Playfair+Display:ital,wght@0,400;0,600;0,700;1,400&family=Lato:wght@300;400;600;700&display=swap');
         
@@ -264,55 +343,77 @@ def load_luxury_css():
             background-color: #F2F0E9 !important;
         }
     </style>
-    """, unsafe_allow_html=True)
+"""
+
+def load_luxury_css():
+    # Va emesso a ogni rerun: Streamlit rimuove gli elementi non ridisegnati nel run corrente
+    st.markdown(LUXURY_CSS, unsafe_allow_html=True)
+
+PRECEDENT_CARD_TEMPLATE = """
+<div class='prec-card' style='border-left-color: {accent};'>
+    <div style='display:flex; justify-content:space-between;'>
+        <div style='font-family: Playfair Display; font-size: 1.1em; font-weight: bold; color: #2C2520;'>{title}</div>
+        <span style='background:#E8E5DD; padding:2px 8px; border-radius:10px; font-size:0.8em; font-weight:bold;'>{conf}% Match</span>
+    </div>
+    <div style='margin-top: 5px; font-size: 0.9em; color: #666;'>{decision}</div>
+    <div style='margin-top: 10px; font-style: italic; font-size: 0.85em; color: #444; line-height: 1.4;'>"{preview}..."</div>
+</div>
+"""
+
+def render_precedent_cards(results, strategy):
+    # Tutte le card in un unico blob HTML: un solo elemento inviato al frontend
+    def card_vars(case):
+        conf = int(case['relevance_score'] * 100) + (case['citation_count'] * 5)
+        return {
+            'accent': "#7A9B76" if (strategy=="defense" and case['is_fav']) else "#C67B5C",
+            'title': html.escape(str(case['title'])),
+            'conf': min(conf, 99),
+            'decision': html.escape(str(case['decision'])),
+            'preview': html.escape(str(case.get('full_text_preview') or '')[:120]),
+        }
+    return "".join(PRECEDENT_CARD_TEMPLATE.format(**card_vars(case)) for case in results)
 
 def render_citation_graph(results, strategy):
-    nodes = []
-    edges = []
-    
     BG = "#F2F0E9"
     USER = "#C67B5C" 
     GOOD = "#7A9B76" 
     BAD = "#8B7D6B"  
     NEUTRAL = "#A8A29E" 
     
-    nodes.append(Node(id="USER", label="Current Case", title="Your Case", size=40, color=USER, font={'color':'#2C2520', 'face':'Lato'}, shape="dot"))
-    existing_nodes = {"USER"}
+    # Precedenti unici (prima occorrenza per id) e anchor unici da found_via
+    cases = {}
+    for case in results:
+        cases.setdefault(str(case['id']), case)
+    sources = {
+        f"SRC_{name.replace(' ', '_')}": name
+        for case in cases.values() for name in case.get('found_via', [])
+    }
     
-    for i, case in enumerate(results):
-        cid = str(case['id'])
-        if cid not in existing_nodes:
-            is_fav = ("reverse" in str(case['decision']).lower() or "acquit" in str(case['decision']).lower())
-            col = GOOD if (strategy=="defense" and is_fav) or (strategy=="prosecution" and not is_fav) else BAD
-            
-            lbl = case['title'][:15] + "..."
-            
-            nodes.append(Node(
-                id=cid, 
-                label=lbl, 
-                title=case['title'], 
-                size=25, 
-                color=col, 
-                font={'color':'#2C2520', 'size':12}
-            ))
-            edges.append(Edge(source="USER", target=cid, color="#A68A64", width=2))
-            existing_nodes.add(cid)
-            
-            found_via_list = case.get('found_via', [])
-            for source_case_name in found_via_list:
-                source_id = f"SRC_{source_case_name.replace(' ', '_')}"
-                if source_id not in existing_nodes:
-                    nodes.append(Node(
-                        id=source_id, 
-                        label=source_case_name[:10]+"..", 
-                        title=source_case_name,
-                        size=15, 
-                        color=NEUTRAL, 
-                        shape="dot", 
-                        font={'color':'#666', 'size':10}
-                    ))
-                    existing_nodes.add(source_id)
-                edges.append(Edge(source=source_id, target=cid, color="#D6D1C9", width=1, type="curved"))
+    nodes = [
+        Node(id="USER", label="Current Case", title="Your Case", size=40, color=USER, font={'color':'#2C2520', 'face':'Lato'}, shape="dot"),
+        *[Node(
+            id=cid, 
+            label=case['title'][:15] + "...", 
+            title=case['title'], 
+            size=25, 
+            color=GOOD if (strategy=="defense") == case['is_fav'] else BAD, 
+            font={'color':'#2C2520', 'size':12}
+        ) for cid, case in cases.items()],
+        *[Node(
+            id=source_id, 
+            label=name[:10]+"..", 
+            title=name,
+            size=15, 
+            color=NEUTRAL, 
+            shape="dot", 
+            font={'color':'#666', 'size':10}
+        ) for source_id, name in sources.items()],
+    ]
+    edges = [
+        *[Edge(source="USER", target=cid, color="#A68A64", width=2) for cid in cases],
+        *[Edge(source=f"SRC_{name.replace(' ', '_')}", target=cid, color="#D6D1C9", width=1, type="curved")
+          for cid, case in cases.items() for name in case.get('found_via', [])],
+    ]
 
     config = Config(
         width="100%", 
@@ -332,6 +433,7 @@ def main():
     if "results" not in st.session_state: st.session_state.results = None
     if "analysis" not in st.session_state: st.session_state.analysis = None
     if "search_method" not in st.session_state: st.session_state.search_method = None
+    if "search_strategy" not in st.session_state: st.session_state.search_strategy = None
     if "case_input" not in st.session_state: st.session_state.case_input = ""
 
     with st.sidebar:
@@ -360,32 +462,24 @@ def main():
             st.session_state.results = None
             st.session_state.analysis = None
             st.session_state.search_method = None
+            st.session_state.search_strategy = None
             st.session_state.case_input = ""
             st.rerun()
 
     if analyze and input_text:
         st.session_state.case_input = input_text
         with st.spinner("Analyzing jurisprudence..."):
-            emb = get_embedding(input_text)
+            emb = get_session_embedding(input_text)
             if emb:
                 # --- STRATEGIA A CASCATA (Fallback Silenzioso) ---
-                
-                results = graph_rag_search(emb, strat_key, apply_filter=True)
-                method = "Gold"
-                
-                if not results:
-                    results = graph_rag_search(emb, strat_key, apply_filter=False)
-                    method = "Silver"
-                
-                if not results:
-                    results = vector_only_search(emb)
-                    method = "Bronze"
+                results, method = cascading_search(emb, strat_key)
                 
                 st.session_state.results = results
                 st.session_state.search_method = method
-                
-                if results:
-                    st.session_state.analysis = generate_strategic_analysis(input_text, results, strat_key, method)
+                st.session_state.search_strategy = strat_key
+                # Il memo viene generato in streaming nella sezione dei risultati, con la
+                # strategia usata per la ricerca (non quella eventualmente cambiata dopo)
+                st.session_state.analysis = None
             else:
                 st.error("Embedding API Error.")
 
@@ -396,7 +490,15 @@ def main():
         # L'interfaccia passa direttamente ai risultati
 
         st.markdown("### Strategic Analysis")
-        st.markdown(f"<div class='paper-card'>{st.session_state.analysis}</div>", unsafe_allow_html=True)
+        if st.session_state.analysis is None:
+            placeholder = st.empty()
+            acc = ""
+            for piece in generate_strategic_analysis(st.session_state.case_input, st.session_state.results, st.session_state.search_strategy, st.session_state.search_method):
+                acc += piece
+                placeholder.markdown(f"<div class='paper-card'>{acc}</div>", unsafe_allow_html=True)
+            st.session_state.analysis = acc
+        else:
+            st.markdown(f"<div class='paper-card'>{st.session_state.analysis}</div>", unsafe_allow_html=True)
         st.markdown("<br>", unsafe_allow_html=True)
         
         col_graph, col_cards = st.columns([1, 1], gap="large")
@@ -408,26 +510,13 @@ def main():
             
         with col_cards:
             st.markdown(f"### Precedents ({len(st.session_state.results)})")
+            st.html(render_precedent_cards(st.session_state.results, strat_key))
+            
+            # Le opinioni complete restano widget separati (interattivi, caricati on demand).
+            # Chiave per (caso, testo): un CASE con piu' nodi :TEXT produce piu' righe con lo stesso id
             for case in st.session_state.results:
-                is_fav = ("reverse" in str(case['decision']).lower() or "acquit" in str(case['decision']).lower())
-                accent = "#7A9B76" if (strat_key=="defense" and is_fav) else "#C67B5C"
-                
-                conf = int(case['relevance_score'] * 100) + (case['citation_count'] * 5)
-                conf = min(conf, 99)
-                
-                st.markdown(f"""
-                <div class='prec-card' style='border-left-color: {accent};'>
-                    <div style='display:flex; justify-content:space-between;'>
-                        <div style='font-family: Playfair Display; font-size: 1.1em; font-weight: bold; color: #2C2520;'>{case['title']}</div>
-                        <span style='background:#E8E5DD; padding:2px 8px; border-radius:10px; font-size:0.8em; font-weight:bold;'>{conf}% Match</span>
-                    </div>
-                    <div style='margin-top: 5px; font-size: 0.9em; color: #666;'>{case['decision']}</div>
-                    <div style='margin-top: 10px; font-style: italic; font-size: 0.85em; color: #444; line-height: 1.4;'>"{str(case.get('full_text',''))[:120]}..."</div>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                with st.expander(f"Read Full Opinion ({case['title']})"):
-                    full_text = html.escape(case.get('full_text', 'No text available'))
+                if st.toggle(f"Read Full Opinion ({case['title']})", key=f"opinion_{case['id']}_{case.get('text_id')}"):
+                    full_text = html.escape(get_full_text(case.get('text_id')) or 'No text available')
                     st.markdown(f"""
                     <div style='height: 300px; overflow-y: auto; padding: 15px; background-color: #FFFFFF; border: 1px solid #EAEAEA; border-radius: 5px; font-family: Georgia, serif; font-size: 0.95em; line-height: 1.6; color: #333;'>
                         {full_text}
@@ -1,6 +1,9 @@
 import os
-import random
 import time
+import hashlib
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from neo4j import GraphDatabase
 from tqdm import tqdm
@@ -21,16 +24,74 @@ except:
 
 genai.configure(api_key=API_KEY)
 EMBEDDING_MODEL = 'text-embedding-004'
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, PWD))
+EMBEDDING_CACHE_FILE = "embedding_cache.db"
+EMBEDDING_BATCH_SIZE = 100
+MAX_WORKERS = 16
+# Pool dimensionato sopra MAX_WORKERS: ogni worker tiene la sua connessione calda
+# senza contendersi il pool con get_test_set o altre sessioni
+driver = GraphDatabase.driver(
+    NEO4J_URI,
+    auth=(NEO4J_USER, PWD),
+    max_connection_pool_size=32,
+    connection_acquisition_timeout=30,
+    max_connection_lifetime=3600
+)
 
-def get_embedding(text):
-    try:
-        return genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=text[:9000],
-            task_type="RETRIEVAL_QUERY"
-        )['embedding']
-    except: return None
+# Una sessione Neo4j per thread worker (le sessioni non sono thread-safe)
+_thread_local = threading.local()
+_open_sessions = []
+_sessions_lock = threading.Lock()
+
+def get_thread_session():
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = driver.session()
+        _thread_local.session = session
+        with _sessions_lock:
+            _open_sessions.append(session)
+    return session
+
+def close_thread_sessions():
+    with _sessions_lock:
+        for session in _open_sessions:
+            session.close()
+        _open_sessions.clear()
+
+def _cache_key(text):
+    return hashlib.sha1(f"{EMBEDDING_MODEL}:{text}".encode("utf-8")).hexdigest()
+
+def get_embeddings(texts):
+    """
+    Embedding in batch con cache shelve su disco (i rerun non richiamano l'API per testi
+    gia' visti): una sola richiesta ogni EMBEDDING_BATCH_SIZE testi mancanti.
+    Restituisce una lista allineata a texts (None dove il batch fallisce; non salvato in cache).
+    """
+    texts = [t[:9000] for t in texts]
+    keys = [_cache_key(t) for t in texts]
+    embeddings = [None] * len(texts)
+    
+    with shelve.open(EMBEDDING_CACHE_FILE) as cache:
+        for i, key in enumerate(keys):
+            if key in cache:
+                embeddings[i] = cache[key]
+        
+        missing = [i for i, emb in enumerate(embeddings) if emb is None]
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            try:
+                result = genai.embed_content(
+                    model=EMBEDDING_MODEL,
+                    content=[texts[i] for i in batch],
+                    task_type="RETRIEVAL_QUERY"
+                )['embedding']
+            except Exception as e:
+                print(f"Errore batch embedding: {e}")
+                continue
+            for i, emb in zip(batch, result):
+                embeddings[i] = emb
+                cache[keys[i]] = emb
+    
+    return embeddings
 
 def get_test_set(sample_size=100):
     """
@@ -52,106 +113,105 @@ def get_test_set(sample_size=100):
         WHERE size(actual_citations) > 0
         
         MATCH (c)-[:HAS_TEXT]->(t:TEXT)
+        WITH c, t, actual_citations, rand() as r
+        ORDER BY r
+        LIMIT $sample_size
         RETURN 
             elementId(c) as id, 
-            t.text as text, 
+            substring(t.text, 0, 9000) as text, 
             c.offense as source_offense,
-            [x in actual_citations | {id: elementId(x), offense: x.offense}] as ground_truth
-        LIMIT 2000
+            [x in actual_citations | {id: elementId(x), offense: toLower(trim(x.offense))}] as ground_truth
     """
+    # Campionamento lato server: viaggiano su Bolt solo i casi estratti
     with driver.session() as session:
-        data = session.run(query).data()
+        data = session.run(query, sample_size=sample_size).data()
     
-    print(f"Casi candidati trovati: {len(data)}")
+    # Ground truth normalizzata una sola volta per caso (offense gia' lowercase/trim lato server)
+    for case in data:
+        case['_true_ids'] = {item['id'] for item in case['ground_truth']}
+        case['_true_offenses'] = {item['offense'] for item in case['ground_truth'] if item['offense']}
     
-    if len(data) > sample_size:
-        return random.sample(data, sample_size)
+    print(f"Casi campionati: {len(data)}")
     return data
 
-def retrieve_cases(embedding, original_id, use_graph=True):
+# Query costanti: nessuna f-string ricostruita a ogni chiamata, testo identico per il plan cache
+# GRAPH RAG (Vettori su CASE -> Traversata)
+GRAPH_QUERY = """
+    CALL db.index.vector.queryNodes($index_name, 50, $embedding) 
+    YIELD node AS anchorCase, score
+    WHERE elementId(anchorCase) <> $original_id
+    
+    MATCH (anchorCase)-[link:CITES_TRANSITIVE]->(precedent:CASE)
+    WHERE precedent.offense IS NOT NULL
+    
+    RETURN elementId(precedent) as id, toLower(trim(precedent.offense)) as offense, sum(score * link.paths) as score
+    ORDER BY score DESC LIMIT 10
+"""
+
+# VECTOR ONLY (Baseline)
+VECTOR_QUERY = """
+    CALL db.index.vector.queryNodes($index_name, 10, $embedding)
+    YIELD node AS precedent, score
+    WHERE elementId(precedent) <> $original_id AND precedent.offense IS NOT NULL
+    
+    RETURN elementId(precedent) as id, toLower(trim(precedent.offense)) as offense, score
+    ORDER BY score DESC LIMIT 10
+"""
+
+def retrieve_cases(embedding, original_id, use_graph, session):
     """
     Esegue la ricerca e restituisce ID e OFFENSE dei casi trovati.
     """
-    index_name = NEO4J_VECTOR_INDEX
-    
-    if use_graph:
-        # GRAPH RAG (Vettori su CASE -> Traversata)
-        query = f"""
-        CALL db.index.vector.queryNodes($index_name, 50, $embedding) 
-        YIELD node AS anchorCase, score
-        WHERE elementId(anchorCase) <> $original_id
-        
-        MATCH (anchorCase)-[:CITES*1..2]->(precedent:CASE)
-        WHERE precedent.offense IS NOT NULL
-        
-        RETURN elementId(precedent) as id, precedent.offense as offense, sum(score) as score
-        ORDER BY score DESC LIMIT 10
-        """
-    else:
-        # VECTOR ONLY (Baseline)
-        query = f"""
-        CALL db.index.vector.queryNodes($index_name, 10, $embedding)
-        YIELD node AS precedent, score
-        WHERE elementId(precedent) <> $original_id AND precedent.offense IS NOT NULL
-        
-        RETURN elementId(precedent) as id, precedent.offense as offense, score
-        ORDER BY score DESC LIMIT 10
-        """
-        
-    with driver.session() as session:
-        results = session.run(query, index_name=index_name, embedding=embedding, original_id=original_id)
-        return [{"id": r["id"], "offense": r["offense"]} for r in results]
+    query = GRAPH_QUERY if use_graph else VECTOR_QUERY
+    results = session.run(query, index_name=NEO4J_VECTOR_INDEX, embedding=embedding, original_id=original_id)
+    return [{"id": r["id"], "offense": r["offense"]} for r in results]
 
-def calculate_score(ground_truth_list, retrieved_list):
+def calculate_score(true_ids, true_offenses, retrieved_list):
     """
     Calcola lo score per un singolo caso.
     - 1.0 punti: Trovato l'ID esatto (Hard Match)
     - 0.5 punti: ID diverso, ma stesso Offense (Soft Match)
     - 0.0 punti: Nessuna corrispondenza
+    Gli offense arrivano gia' normalizzati (lowercase, trim) dalle query.
     """
-    # Set di ID veri e Offense veri
-    true_ids = {item['id'] for item in ground_truth_list}
-    
-    # Normalizziamo le stringhe offense (lowercase, strip) per il confronto
-    true_offenses = {str(item['offense']).strip().lower() for item in ground_truth_list if item['offense']}
+    if any(found['id'] in true_ids for found in retrieved_list):
+        return 1.0 # JACKPOT: Trovato esattamente il caso citato!
     
-    max_points = 0.0
-    
-    for found in retrieved_list:
-        found_id = found['id']
-        found_offense = str(found['offense']).strip().lower() if found['offense'] else ""
-        
-        if found_id in true_ids:
-            return 1.0 # JACKPOT: Trovato esattamente il caso citato!
-        
-        if found_offense in true_offenses:
-            max_points = 0.5 # SOFT MATCH: Caso analogo trovato
+    if any(found['offense'] in true_offenses for found in retrieved_list):
+        return 0.5 # SOFT MATCH: Caso analogo trovato
             
-    return max_points
+    return 0.0
+
+def eval_case(case, emb):
+    """
+    Valuta un singolo caso: (score vector, score graph).
+    """
+    session = get_thread_session()
+    true_ids, true_offenses = case['_true_ids'], case['_true_offenses']
+    score_v = calculate_score(true_ids, true_offenses, retrieve_cases(emb, case['id'], False, session))
+    score_g = calculate_score(true_ids, true_offenses, retrieve_cases(emb, case['id'], True, session))
+    return score_v, score_g
 
 def main():
     test_cases = get_test_set(150) # Testiamo su 150 casi
     print(f"Test Set: {len(test_cases)} casi pronti.\n")
     
-    vector_scores = []
-    graph_scores = []
+    print("--- EMBEDDING (batch) ---")
+    texts = [case['text'][:4000] for case in test_cases] # Simuliamo input utente
+    embeddings = get_embeddings(texts)
+    pairs = [(case, emb) for case, emb in zip(test_cases, embeddings) if emb]
     
     print("--- STARTING EVALUATION ---")
     
-    for i, case in enumerate(tqdm(test_cases)):
-        input_text = case['text'][:4000] # Simuliamo input utente
-        emb = get_embedding(input_text)
-        if not emb: continue
-        
-        # 1. Test Vector
-        res_v = retrieve_cases(emb, case['id'], use_graph=False)
-        score_v = calculate_score(case['ground_truth'], res_v)
-        vector_scores.append(score_v)
-        
-        # 2. Test Graph
-        res_g = retrieve_cases(emb, case['id'], use_graph=True)
-        score_g = calculate_score(case['ground_truth'], res_g)
-        graph_scores.append(score_g)
+    # Le query Neo4j sono I/O bound: le eseguiamo in parallelo (il driver e' thread-safe)
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            results = list(tqdm(ex.map(lambda p: eval_case(*p), pairs), total=len(pairs)))
+    finally:
+        close_thread_sessions()
+    
+    vector_scores = [score_v for score_v, _ in results]
+    graph_scores = [score_g for _, score_g in results]
 
     # --- CALCOLO FINALE ---
     avg_vector = np.mean(vector_scores) * 100
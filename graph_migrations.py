@@ -0,0 +1,161 @@
+import re
+import sys
+import uuid
+from neo4j import GraphDatabase
+
+# --- CONFIGURAZIONE ---
+NEO4J_URI = "bolt://localhost:7687"
+NEO4J_USER = "neo4j"
+NEO4J_VECTOR_INDEX = "case-text-embeddings"
+INDEX_AWAIT_TIMEOUT = 3600 # secondi
+
+# Caricamento chiavi
+try:
+    with open("neo4j_pass.txt", "r") as f: PWD = f.read().strip()
+except:
+    print("Errore: file credenziali mancanti.")
+    exit()
+
+driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, PWD))
+
+def add_outcome_property(session):
+    """
+    Normalizza decisionSummary in c.outcome (reversed / acquitted / affirmed / other)
+    e c.is_defense_favorable, cosi' i filtri di strategia confrontano un valore gia'
+    calcolato invece di fare toLower + CONTAINS su ogni precedente espanso.
+    """
+    print("--- Calcolo c.outcome ---")
+    session.run("""
+        MATCH (c:CASE)
+        WITH c, toLower(coalesce(c.decisionSummary, '')) AS summary
+        SET c.outcome = CASE
+            WHEN summary CONTAINS 'reverse' THEN 'reversed'
+            WHEN summary CONTAINS 'acquit' THEN 'acquitted'
+            WHEN summary CONTAINS 'affirm' THEN 'affirmed'
+            ELSE 'other'
+        END
+    """).consume()
+    # Flag booleano precalcolato: l'app non deve piu' analizzare la stringa a ogni render
+    session.run("""
+        MATCH (c:CASE)
+        SET c.is_defense_favorable = c.outcome IN ['reversed', 'acquitted']
+    """).consume()
+
+def drop_unused_indexes(session):
+    # offense, outcome e is_defense_favorable sono letti solo su nodi gia' raggiunti dal
+    # vector index o dalla traversata (mai usati per un seek): un indice costerebbe solo
+    # in scrittura. Rimossi quelli creati da versioni precedenti di questo script.
+    print("--- Rimozione indici inutilizzati ---")
+    for name in ["case_offense", "case_outcome", "case_defense_favorable"]:
+        session.run(f"DROP INDEX {name} IF EXISTS").consume()
+
+def build_transitive_citations(session):
+    """
+    Materializza (a)-[:CITES_TRANSITIVE]->(b) per ogni b raggiungibile con CITES*1..2.
+    hops = distanza minima, paths = numero di percorsi (la vecchia traversata produceva
+    una riga per percorso, quindi sum(r.paths) preserva i conteggi delle query).
+    Aggiornamento senza buchi: gli archi vengono marcati con l'id dell'esecuzione e solo
+    alla fine si eliminano quelli non piu' validi, cosi' l'app vede sempre archi completi.
+    """
+    print("--- Aggiornamento :CITES_TRANSITIVE ---")
+    run_id = uuid.uuid4().hex
+    session.run("""
+        MATCH (a:CASE)
+        CALL {
+            WITH a
+            MATCH path = (a)-[:CITES*1..2]->(b:CASE)
+            WITH a, b, min(length(path)) AS hops, count(path) AS paths
+            MERGE (a)-[r:CITES_TRANSITIVE]->(b)
+            SET r.hops = hops, r.paths = paths, r.run = $run_id
+        } IN TRANSACTIONS OF 500 ROWS
+    """, run_id=run_id).consume()
+    # Solo archi di esecuzioni precedenti (citazioni rimosse): se lo step sopra fallisce
+    # a meta' non si arriva qui e gli archi esistenti restano intatti
+    session.run("""
+        MATCH ()-[r:CITES_TRANSITIVE]->()
+        WHERE r.run IS NULL OR r.run <> $run_id
+        CALL { WITH r DELETE r } IN TRANSACTIONS OF 10000 ROWS
+    """, run_id=run_id).consume()
+
+def server_version(session):
+    version = session.run("""
+        CALL dbms.components() YIELD name, versions
+        WHERE name = 'Neo4j Kernel'
+        RETURN versions[0] AS version
+    """).single()["version"]
+    return tuple(int(x) for x in re.findall(r"\d+", version)[:2])
+
+def create_vector_index(session, label, prop, config, quantized):
+    # Nomi e OPTIONS degli indici non sono parametrizzabili in Cypher.
+    # Niente IF NOT EXISTS: un conflitto deve emergere come errore, non essere ignorato.
+    quantization = "true" if quantized else "false"
+    session.run(f"""
+        CREATE VECTOR INDEX `{NEO4J_VECTOR_INDEX}`
+        FOR (c:`{label}`) ON (c.`{prop}`)
+        OPTIONS {{indexConfig: {{
+            `vector.dimensions`: {int(config["vector.dimensions"])},
+            `vector.similarity_function`: '{config["vector.similarity_function"]}',
+            `vector.quantization.enabled`: {quantization}
+        }}}}
+    """).consume()
+
+def await_vector_index(session):
+    print("Attesa popolamento vector index...")
+    session.run("CALL db.awaitIndex($name, $timeout)", name=NEO4J_VECTOR_INDEX, timeout=INDEX_AWAIT_TIMEOUT).consume()
+
+def quantize_vector_index(session):
+    """
+    Passo di MANUTENZIONE (solo con --quantize-vector-index): ricrea il vector index con
+    quantizzazione int8 (Neo4j 5.23+), vettori 4x piu' piccoli e meno banda per ogni passo ANN.
+    Neo4j ammette un solo indice vector per label/proprieta' e non rinomina gli indici, quindi
+    si fa DROP -> CREATE -> db.awaitIndex sullo stesso nome: finche' il nuovo indice non e'
+    ONLINE la ricerca vettoriale dell'app e del benchmark non e' disponibile.
+    """
+    print("--- Quantizzazione vector index (manutenzione) ---")
+    if server_version(session) < (5, 23):
+        print("Neo4j < 5.23: quantizzazione non supportata, indice lasciato invariato.")
+        return
+    
+    record = session.run("""
+        SHOW VECTOR INDEXES YIELD name, labelsOrTypes, properties, options
+        WHERE name = $name
+        RETURN labelsOrTypes, properties, options
+    """, name=NEO4J_VECTOR_INDEX).single()
+    if record is None:
+        raise RuntimeError(f"Vector index '{NEO4J_VECTOR_INDEX}' non trovato: crearlo prima di lanciare le migrazioni.")
+    
+    config = record["options"]["indexConfig"]
+    if config.get("vector.quantization.enabled"):
+        print("Indice gia' quantizzato.")
+        return
+    
+    label, prop = record["labelsOrTypes"][0], record["properties"][0]
+    print("ATTENZIONE: ricerca vettoriale non disponibile fino a fine popolamento.")
+    session.run(f"DROP INDEX `{NEO4J_VECTOR_INDEX}`").consume()
+    try:
+        create_vector_index(session, label, prop, config, quantized=True)
+    except Exception:
+        # Mai lasciare il database senza vector index: si ripristina la configurazione originale
+        print("Creazione fallita: ripristino dell'indice non quantizzato.")
+        create_vector_index(session, label, prop, config, quantized=False)
+        await_vector_index(session)
+        raise
+    await_vector_index(session)
+    print(f"Indice '{NEO4J_VECTOR_INDEX}' quantizzato e ONLINE.")
+
+def main():
+    # Idempotente: va rilanciato dopo ogni nuovo import di nodi :CASE.
+    # La quantizzazione del vector index e' un passo di manutenzione separato (opt-in)
+    # perche' comporta un breve disservizio della ricerca vettoriale durante la ricostruzione.
+    with driver.session() as session:
+        add_outcome_property(session)
+        drop_unused_indexes(session)
+        build_transitive_citations(session)
+        if "--quantize-vector-index" in sys.argv:
+            quantize_vector_index(session)
+
+    print("\n--- FATTO: migrazioni applicate ---")
+    driver.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file